@@ -75,6 +75,7 @@ setup(name='wordops',
       ],
       extras_require={  # Optional
           'testing': ['nose', 'coverage'],
+          'backup': ['isal', 'zstandard', 'crc32c'],
       },
       data_files=[('/etc/wo', ['config/wo.conf']),
                   ('/etc/wo/plugins.d', conf),
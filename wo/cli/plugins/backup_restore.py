@@ -1,13 +1,19 @@
 """ Backup and Restore Plugin for WordOps """
 
+import functools
 import os
 import re
 import tarfile
 import tempfile
 import shutil
 import subprocess
+import threading
+import zlib
 import pwd
 import grp
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 from cement.core.controller import CementBaseController, expose
@@ -16,45 +22,602 @@ from wo.core.logging import Log
 from wo.core.util import WOUtil
 from wo.core.shellexec import WOShellExec
 
+try:
+    # ISA-L's SIMD-accelerated DEFLATE, a drop-in replacement for stdlib gzip
+    from isal import igzip as gzip_impl
+    from isal.igzip_lib import IsalError
+except ImportError:
+    import gzip as gzip_impl
+    IsalError = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    # Hardware-accelerated CRC32C (SSE4.2/ARMv8 crc instructions)
+    import crc32c
+except ImportError:
+    crc32c = None
+
+# Matches define('DB_NAME|DB_USER|DB_PASSWORD|DB_HOST', 'VALUE'); in wp-config.php
+_DB_CREDS_RE = re.compile(rb"define\(\s*'DB_(NAME|USER|PASSWORD|HOST)',\s*'([^']+)'\s*\);")
+# mysqldump errors caused by --single-transaction rather than by the dump
+# itself (missing RELOAD/FLUSH_TABLES privilege, no snapshot support)
+_SNAPSHOT_ERROR_RE = re.compile(
+    r"TRANSACTION|CONSISTENT SNAPSHOT|SAVEPOINT|FLUSH TABLES|RELOAD", re.IGNORECASE)
+# Database names safe to interpolate into a backquoted identifier
+_DB_NAME_RE = re.compile(r"[A-Za-z0-9_]+")
+# Characters escaped inside a quoted MySQL option file value
+_OPTION_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r'})
+
 # --- Configuration ---
 BACKUP_BASE_DIR = "/var/www/backups"
+# Server socket used for localhost connections, as in the WordOps my.cnf
+MYSQL_SOCKET = "/run/mysqld/mysqld.sock"
+# Buffer size used for archive blocks and tar member copies
+COPY_BUFSIZE = 1024 * 1024
+# Archive file extension for each --format choice
+ARCHIVE_EXTENSIONS = {'gzip': 'tar.gz', 'zstd': 'tar.zst'}
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Sidecar file holding the CRC32C of a backup archive
+CHECKSUM_SUFFIX = '.crc32c'
+# Raised by the in-process decompressors on truncated or corrupt archives
+CODEC_ERRORS = tuple(
+    error for error in (EOFError, zlib.error, IsalError,
+                        zstandard.ZstdError if zstandard is not None else None)
+    if error is not None)
+# Statements wrapped around a dump when importing it on restore
+IMPORT_PROLOGUE = b"SET autocommit=0; SET unique_checks=0; SET foreign_key_checks=0;\n"
+IMPORT_EPILOGUE = b"\nCOMMIT; SET foreign_key_checks=1; SET unique_checks=1;\n"
+# Dumps smaller than this stay in memory while being archived
+DUMP_SPOOL_SIZE = 256 * 1024 * 1024
 
 def _get_db_creds(wp_config_path):
-    """Parses wp-config.php to get database credentials."""
+    """Returns the database credentials from wp-config.php, or None.
+
+    Results are cached per file version, so repeated reads within one run
+    skip the parse until the file changes.
+    """
+    try:
+        st = os.stat(wp_config_path)
+    except OSError:
+        return None
+    return _parse_db_creds(wp_config_path, st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=64)
+def _parse_db_creds(wp_config_path, mtime_ns, size):
+    """Parses wp-config.php to get database credentials.
+
+    mtime_ns and size are only part of the cache key.
+    """
     creds = {}
     try:
-        with open(wp_config_path, 'r') as f:
-            config_content = f.read()
-            # Regex to find define('KEY', 'VALUE');
-            patterns = {
-                'name': r"define\(\s*'DB_NAME',\s*'([^']+)'\s*\);",
-                'user': r"define\(\s*'DB_USER',\s*'([^']+)'\s*\);",
-                'password': r"define\(\s*'DB_PASSWORD',\s*'([^']+)'\s*\);",
-            }
-            for key, pattern in patterns.items():
-                match = re.search(pattern, config_content)
-                if match:
-                    creds[key] = match.group(1)
-            return creds if len(creds) == 3 else None
-    except IOError:
+        with open(wp_config_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as config_content:
+            for match in _DB_CREDS_RE.finditer(config_content):
+                # Keep the first definition, as WordPress does
+                creds.setdefault(match.group(1).decode().lower(),
+                                 match.group(2).decode('utf-8'))
+            # DB_HOST is optional, WordPress defaults it to localhost
+            return creds if {'name', 'user', 'password'} <= creds.keys() else None
+    except (IOError, ValueError):
+        # ValueError covers empty files, which cannot be mapped, and
+        # values that are not valid UTF-8
         return None
 
+@functools.lru_cache(maxsize=32)
+def _uid_gid(user, group):
+    """Returns the (uid, gid) pair for a user and group name."""
+    return pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid
+
+def _scandir_chown(path, uid, gid):
+    """Recursively chowns the entries below path using os.scandir."""
+    with os.scandir(path) as it:
+        for entry in it:
+            os.chown(entry.path, uid, gid, follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                _scandir_chown(entry.path, uid, gid)
+
+def _chown_tree(path, uid, gid):
+    """Recursively chowns path, never following symlinks.
+
+    Where os.fwalk exists, entries are chowned relative to their open
+    parent directory, sparing the kernel a full path lookup per entry.
+    """
+    os.chown(path, uid, gid)
+    if not hasattr(os, 'fwalk'):
+        _scandir_chown(path, uid, gid)
+        return
+    for _root, dirs, files, rootfd in os.fwalk(path):
+        for name in dirs + files:
+            os.chown(name, uid, gid, dir_fd=rootfd, follow_symlinks=False)
+
 def _set_permissions(path, user='www-data', group='www-data'):
     """Recursively sets ownership for a path."""
     try:
-        uid = pwd.getpwnam(user).pw_uid
-        gid = grp.getgrnam(group).gr_gid
+        uid, gid = _uid_gid(user, group)
         os.chown(path, uid, gid)
-        for root, dirs, files in os.walk(path):
-            for d in dirs:
-                os.chown(os.path.join(root, d), uid, gid)
-            for f in files:
-                os.chown(os.path.join(root, f), uid, gid)
+        # chown releases the GIL, so top-level subtrees are chowned in parallel
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+            subtrees = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subtrees.append(pool.submit(_chown_tree, entry.path, uid, gid))
+                    else:
+                        os.chown(entry.path, uid, gid, follow_symlinks=False)
+            for subtree in subtrees:
+                subtree.result()
         return True
     except (KeyError, OSError) as e:
         Log.debug(f"Could not set permissions: {e}")
         return False
 
+def _option_value(value):
+    """Quotes a value for a MySQL option file."""
+    return '"{}"'.format(value.translate(_OPTION_ESCAPES))
+
+def _mysql_connection_options(db_host):
+    """Returns client options connecting to a wp-config.php DB_HOST.
+
+    DB_HOST may carry a port or a socket path after a colon, as WordPress
+    allows. localhost connects through the server socket.
+    """
+    host, _, port_or_socket = db_host.partition(':')
+    if host in ('', 'localhost'):
+        socket = port_or_socket if port_or_socket.startswith('/') else MYSQL_SOCKET
+        return {'socket': socket}
+    options = {'host': host}
+    if port_or_socket.isdigit():
+        options['port'] = port_or_socket
+    return options
+
+@contextmanager
+def _mysql_defaults_file(db_creds):
+    """Yields a --defaults-file option holding the site's credentials.
+
+    Keeps the password out of the client argv, where it shows up in ps
+    and makes the clients warn. As the only option file read, it also
+    stops root's credentials in ~/.my.cnf or /etc/mysql/conf.d/my.cnf
+    from taking precedence. The file is removed on exit.
+    """
+    options = {'user': db_creds['user'], 'password': db_creds['password'],
+               **_mysql_connection_options(db_creds.get('host', 'localhost'))}
+    with tempfile.NamedTemporaryFile('w', prefix='wo-', suffix='.cnf',
+                                     delete=False) as f:
+        os.chmod(f.name, 0o600)
+        f.write("[client]\n")
+        for key, value in options.items():
+            f.write(f"{key}={_option_value(value)}\n")
+    try:
+        # Must be the first client argument
+        yield f"--defaults-file={f.name}"
+    finally:
+        os.unlink(f.name)
+
+def _dump_database(mysql_defaults, db_name, single_transaction=True):
+    """Dumps a database into a spooled file, returning (spool, error).
+
+    The spool stays in memory until the dump outgrows DUMP_SPOOL_SIZE and
+    is left positioned at the end of the dump. On failure spool is None.
+    """
+    options = ['--quick', '--no-tablespaces', '--skip-comments', '--net-buffer-length=1M']
+    if single_transaction:
+        # Consistent InnoDB snapshot (the WordPress default engine) without
+        # locking tables, so the live site keeps serving during the dump
+        options.insert(0, '--single-transaction')
+    spool = tempfile.SpooledTemporaryFile(max_size=DUMP_SPOOL_SIZE)
+    # stderr goes to a file: a second pipe read only after stdout hits EOF
+    # would deadlock once mysqldump fills it
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(
+            ['mysqldump', mysql_defaults, *options, db_name],
+            stdout=subprocess.PIPE, stderr=stderr_file, bufsize=COPY_BUFSIZE
+        )
+        shutil.copyfileobj(process.stdout, spool, COPY_BUFSIZE)
+        process.stdout.close()
+        returncode = process.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors='replace')
+    if returncode != 0:
+        spool.close()
+        return None, stderr
+    return spool, None
+
+def _dump_site_database(app, db_creds):
+    """Dumps the site database, retrying with table locks if the snapshot fails."""
+    with _mysql_defaults_file(db_creds) as mysql_defaults:
+        db_dump, dump_error = _dump_database(mysql_defaults, db_creds['name'])
+        if db_dump is None and _SNAPSHOT_ERROR_RE.search(dump_error):
+            Log.warn(app, "Consistent snapshot dump failed, retrying with table locks: "
+                          f"{dump_error.strip()}")
+            db_dump, dump_error = _dump_database(mysql_defaults, db_creds['name'],
+                                                 single_transaction=False)
+    return db_dump, dump_error
+
+def _drop_tables(mysql_defaults, name):
+    """Drops every table of a database, returning an error message or None."""
+    tables_proc = subprocess.run(
+        ['mysql', mysql_defaults, '-N', name, '-e', "SHOW TABLES;"],
+        capture_output=True, text=True, check=False
+    )
+    if tables_proc.returncode != 0:
+        return f"Failed to list tables: {tables_proc.stderr}"
+    tables = [t for t in tables_proc.stdout.split('\n') if t]
+    if not tables:
+        return None
+    drop_sql = ("SET FOREIGN_KEY_CHECKS=0; " +
+                "".join(f"DROP TABLE IF EXISTS `{t}`;" for t in tables) +
+                " SET FOREIGN_KEY_CHECKS=1;")
+    drop_proc = subprocess.run(
+        ['mysql', mysql_defaults, name, '-e', drop_sql],
+        capture_output=True, text=True, check=False
+    )
+    if drop_proc.returncode != 0:
+        return f"Failed to drop tables: {drop_proc.stderr}"
+    return None
+
+def _empty_database(app, mysql_defaults, name):
+    """Empties a database for restore, returning an error message or None.
+
+    The database is dropped and recreated when the name is a plain
+    identifier and the user may drop it, otherwise its tables are dropped
+    one by one. A database dropped but not recreated is an error, as the
+    table-by-table path has nothing left to work on.
+    """
+    if not _DB_NAME_RE.fullmatch(name):
+        Log.debug(app, f"Database name '{name}' is not a plain identifier, dropping tables one by one")
+        return _drop_tables(mysql_defaults, name)
+    drop_proc = subprocess.run(
+        ['mysql', mysql_defaults, '-e', f"DROP DATABASE IF EXISTS `{name}`;"],
+        capture_output=True, text=True, check=False
+    )
+    if drop_proc.returncode != 0:
+        Log.debug(app, f"Could not drop database '{name}', dropping tables one by one: {drop_proc.stderr}")
+        return _drop_tables(mysql_defaults, name)
+    create_proc = subprocess.run(
+        ['mysql', mysql_defaults, '-e', f"CREATE DATABASE `{name}` DEFAULT CHARACTER SET utf8mb4;"],
+        capture_output=True, text=True, check=False
+    )
+    if create_proc.returncode != 0:
+        return f"Database '{name}' was dropped but could not be recreated: {create_proc.stderr}"
+    return None
+
+def _import_session(dump):
+    """Yields a SQL dump wrapped in a bulk-import session.
+
+    Rows are committed once at the end instead of per statement, with
+    unique and foreign key checks off for the duration of the import.
+    """
+    yield IMPORT_PROLOGUE
+    yield from iter(lambda: dump.read(COPY_BUFSIZE), b'')
+    yield IMPORT_EPILOGUE
+
+def _import_database(mysql_defaults, name, dump_path):
+    """Imports a SQL dump file, returning the mysql error output or None."""
+    with open(dump_path, 'rb') as f:
+        import_proc = subprocess.Popen(
+            ['mysql', mysql_defaults, name],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        try:
+            for chunk in _import_session(f):
+                import_proc.stdin.write(chunk)
+        except BrokenPipeError:
+            # mysql stopped reading, its stderr tells why
+            pass
+        _, import_error = import_proc.communicate()
+    if import_proc.returncode != 0:
+        return import_error.decode(errors='replace') or f"mysql exited with status {import_proc.returncode}"
+    return None
+
+def _restore_database(app, db_creds, dump_path):
+    """Empties the site database and imports dump_path, returning an error message or None."""
+    with _mysql_defaults_file(db_creds) as mysql_defaults:
+        Log.info(app, f"-> Dropping all tables from database '{db_creds['name']}'...")
+        db_error = _empty_database(app, mysql_defaults, db_creds['name'])
+        if db_error:
+            return db_error
+
+        Log.info(app, "-> Importing database from backup...")
+        import_error = _import_database(mysql_defaults, db_creds['name'], dump_path)
+        if import_error:
+            return f"Database import failed: {import_error}"
+    return None
+
+@contextmanager
+def _pipe_writer(cmd, path):
+    """Yields the stdin of cmd, whose stdout is written to path."""
+    with open(path, 'wb') as out:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+        try:
+            yield process.stdin
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = process.wait()
+    if returncode != 0:
+        raise OSError(f"{os.path.basename(cmd[0])} exited with status {returncode}")
+
+@contextmanager
+def _pipe_reader(cmd):
+    """Yields the stdout of cmd."""
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        yield process.stdout
+        # Drain the trailing tar padding so cmd does not die on SIGPIPE
+        while process.stdout.read(COPY_BUFSIZE):
+            pass
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise OSError(f"{os.path.basename(cmd[0])} exited with status {returncode}")
+
+def _file_crc32c(path):
+    """Returns the CRC32C of a file as a hex string."""
+    value = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BUFSIZE), b''):
+            value = crc32c.crc32c(chunk, value)
+    return f"{value:08x}"
+
+def _write_checksum(app, backup_path):
+    """Saves the CRC32C of a backup archive in its sidecar file.
+
+    A missing crc32c module or a failed write only costs the restore-time
+    verification, so neither fails the backup.
+    """
+    if crc32c is None:
+        Log.debug(app, "crc32c module not installed, not saving a backup checksum")
+        return
+    checksum_path = backup_path + CHECKSUM_SUFFIX
+    try:
+        with open(checksum_path, 'w') as f:
+            f.write(f"{_file_crc32c(backup_path)}  {os.path.basename(backup_path)}\n")
+    except OSError as e:
+        Log.warn(app, f"Could not save backup checksum to {checksum_path}: {e}")
+
+def _verify_checksum(app, backup_path):
+    """Checks a backup archive against its sidecar, returning an error or None.
+
+    Archives without a sidecar, or without the crc32c module to check
+    them, are let through.
+    """
+    checksum_path = backup_path + CHECKSUM_SUFFIX
+    if not os.path.isfile(checksum_path):
+        return None
+    if crc32c is None:
+        Log.warn(app, "crc32c module not installed, skipping backup checksum verification.")
+        return None
+    Log.info(app, "-> Verifying backup checksum...")
+    try:
+        with open(checksum_path) as f:
+            expected = f.read().split(maxsplit=1)
+        if expected and expected[0].lower() == _file_crc32c(backup_path):
+            return None
+    except OSError as e:
+        return f"Could not verify backup checksum: {e}"
+    return f"Backup file does not match its checksum in {checksum_path}"
+
+def _write_tar_member(out, tarinfo, fileobj):
+    """Writes a single tar member, without end-of-archive marker, to out."""
+    out.write(tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING,
+                            'surrogateescape'))
+    shutil.copyfileobj(fileobj, out, COPY_BUFSIZE)
+    remainder = tarinfo.size % tarfile.BLOCKSIZE
+    if remainder:
+        out.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+def _system_tar(tar_bin, out, tar_args):
+    """Streams an uncompressed archive created by the tar binary into out.
+
+    Returns tar's exit status, where 1 only means some files changed while
+    being read. Any other failure raises OSError.
+    """
+    process = subprocess.Popen([tar_bin, '--create', '--file=-', *tar_args],
+                               stdout=subprocess.PIPE)
+    try:
+        shutil.copyfileobj(process.stdout, out, COPY_BUFSIZE)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode > 1:
+        raise OSError(f"tar exited with status {returncode}")
+    return returncode
+
+def _write_archive(app, out, dump_info, db_dump, sitename, include_nginx_config):
+    """Writes the dump, htdocs and optionally the Nginx config of a site as a tar stream."""
+    site_root = f'/var/www/{sitename}'
+    tar_bin = shutil.which('tar')
+    if tar_bin:
+        # The system tar walks the site tree natively, right after the
+        # dump member written here
+        _write_tar_member(out, dump_info, db_dump)
+        tar_args = ['-C', site_root, 'htdocs']
+        if include_nginx_config:
+            tar_args += ['--transform=s,^sites-available/,nginx/,SH',
+                         '-C', '/etc/nginx', f'sites-available/{sitename}']
+        if _system_tar(tar_bin, out, tar_args) == 1:
+            Log.warn(app, "Some files changed while being archived.")
+        return
+    with tarfile.open(fileobj=out, mode="w|", bufsize=COPY_BUFSIZE,
+                      copybufsize=COPY_BUFSIZE) as tar:
+        tar.addfile(dump_info, db_dump)
+        tar.add(f'{site_root}/htdocs', arcname='htdocs')
+        if include_nginx_config:
+            tar.add(f'/etc/nginx/sites-available/{sitename}', arcname=f'nginx/{sitename}')
+
+def _create_archive(app, backup_filepath, fmt, db_dump, sitename):
+    """Writes the backup archive from db_dump and the site files, returning an error or None.
+
+    A partially written archive is removed on failure.
+    """
+    nginx_config_path = f'/etc/nginx/sites-available/{sitename}'
+    has_nginx_config = os.path.isfile(nginx_config_path)
+    if not has_nginx_config:
+        Log.warn(app, f"Nginx config not found at {nginx_config_path}, skipping.")
+    dump_info = tarfile.TarInfo('database.sql')
+    dump_info.size = db_dump.tell()
+    dump_info.mtime = int(datetime.now().timestamp())
+    dump_info.mode = 0o644
+    db_dump.seek(0)
+    try:
+        with _compressed_writer(backup_filepath, fmt) as out:
+            _write_archive(app, out, dump_info, db_dump, sitename, has_nginx_config)
+    except (OSError, *CODEC_ERRORS) as e:
+        if os.path.isfile(backup_filepath):
+            os.remove(backup_filepath)
+        return str(e)
+    return None
+
+def _restore_members(tar):
+    """Yields the members of a backup archive that restore uses.
+
+    Anything outside htdocs/, nginx/ and database.sql is skipped without
+    being written to disk.
+    """
+    for member in tar:
+        if member.name == 'database.sql' or \
+                member.name.split('/', 1)[0] in ('htdocs', 'nginx'):
+            yield member
+
+def _restore_filter(member, dest_path):
+    """Applies the 'data' extraction filter, relaxed for symlinks.
+
+    Symlinks go through the 'tar' filter instead, so absolute links such
+    as uploads kept on shared storage are restored rather than rejected.
+    The 'tar' filter still keeps the link itself inside dest_path.
+    """
+    if member.issym():
+        return tarfile.tar_filter(member, dest_path)
+    return tarfile.data_filter(member, dest_path)
+
+# Extraction filter rejecting absolute paths, escaping hardlinks and special
+# files (Python 3.12+ and the tarfile security backports)
+EXTRACT_FILTER = {'filter': _restore_filter} if hasattr(tarfile, 'data_filter') else {}
+
+def _swap_htdocs(new_htdocs, htdocs_path, old_htdocs):
+    """Moves new_htdocs into place, keeping the previous tree at old_htdocs."""
+    if os.path.isdir(htdocs_path):
+        os.rename(htdocs_path, old_htdocs)
+    try:
+        os.rename(new_htdocs, htdocs_path)
+    except OSError:
+        if os.path.isdir(old_htdocs):
+            os.rename(old_htdocs, htdocs_path)
+        raise
+
+def _install_site_files(app, temp_dir, sitename):
+    """Moves the extracted site files into place, returning an error message or None."""
+    htdocs_path = f'/var/www/{sitename}/htdocs'
+    extracted_nginx_conf = os.path.join(temp_dir, 'nginx', sitename)
+
+    Log.info(app, "-> Replacing website files...")
+    # The old files are moved into temp_dir and deleted with it
+    try:
+        _swap_htdocs(os.path.join(temp_dir, 'htdocs'), htdocs_path,
+                     os.path.join(temp_dir, 'htdocs.old'))
+    except OSError as e:
+        return f"Unable to replace website files: {e}"
+
+    if os.path.isfile(extracted_nginx_conf):
+        Log.info(app, "-> Restoring Nginx configuration...")
+        shutil.copy(extracted_nginx_conf, f'/etc/nginx/sites-available/{sitename}')
+
+    Log.info(app, "-> Setting file and directory permissions...")
+    if not _set_permissions(htdocs_path):
+        Log.warn(app, "Could not set www-data permissions. Please set them manually.")
+    return None
+
+def _archive_format(path):
+    """Returns the compression format of an archive from its magic bytes."""
+    with open(path, 'rb') as f:
+        return 'zstd' if f.read(4) == ZSTD_MAGIC else 'gzip'
+
+@contextmanager
+def _compressed_writer(path, fmt='gzip'):
+    """Yields a file object compressing everything written to it into path.
+
+    gzip uses pigz to compress on all cores when available, otherwise isal
+    or stdlib gzip in-process. zstd uses the zstandard bindings when
+    available, otherwise the zstd binary.
+    """
+    cpus = str(os.cpu_count() or 1)
+    if fmt == 'zstd':
+        if zstandard is not None:
+            cctx = zstandard.ZstdCompressor(level=3, threads=-1, write_checksum=True)
+            with open(path, 'wb') as f, cctx.stream_writer(f) as out:
+                yield out
+            return
+        zstd = shutil.which('zstd')
+        if not zstd:
+            raise OSError("zstd format requires the zstandard module or the zstd binary")
+        with _pipe_writer([zstd, '-3', f'-T{cpus}', '-q', '-c'], path) as out:
+            yield out
+        return
+    pigz = shutil.which('pigz')
+    if not pigz:
+        with gzip_impl.open(path, 'wb') as out:
+            yield out
+        return
+    with _pipe_writer([pigz, '-p', cpus, '-c'], path) as out:
+        yield out
+
+@contextmanager
+def _decompressed_reader(path):
+    """Yields a file object reading the decompressed contents of path.
+
+    The format is detected from the archive itself and decompressed with
+    the same tools _compressed_writer prefers.
+    """
+    if _archive_format(path) == 'zstd':
+        if zstandard is not None:
+            dctx = zstandard.ZstdDecompressor()
+            with open(path, 'rb', buffering=COPY_BUFSIZE) as archive, \
+                    dctx.stream_reader(archive, read_across_frames=True) as out:
+                yield out
+            return
+        zstd = shutil.which('zstd')
+        if not zstd:
+            raise OSError("zstd archives require the zstandard module or the zstd binary")
+        with _pipe_reader([zstd, '-d', '-q', '-c', path]) as out:
+            yield out
+        return
+    pigz = shutil.which('pigz')
+    if not pigz:
+        with open(path, 'rb', buffering=COPY_BUFSIZE) as archive, \
+                gzip_impl.open(archive, 'rb') as out:
+            yield out
+        return
+    with _pipe_reader([pigz, '-d', '-c', path]) as out:
+        yield out
+
+def _extract_backup(app, backup_path, dest_path):
+    """Verifies and extracts a backup archive, returning an error message or None."""
+    checksum_error = _verify_checksum(app, backup_path)
+    if checksum_error:
+        return checksum_error
+
+    Log.info(app, "-> Extracting backup file...")
+    try:
+        with _decompressed_reader(backup_path) as archive, \
+                tarfile.open(fileobj=archive, mode="r|", bufsize=COPY_BUFSIZE,
+                             copybufsize=COPY_BUFSIZE) as tar:
+            tar.extractall(path=dest_path, members=_restore_members(tar),
+                           **EXTRACT_FILTER)
+    except (tarfile.TarError, OSError, *CODEC_ERRORS) as e:
+        return f"Unable to extract backup archive: {e}"
+
+    if not os.path.isdir(os.path.join(dest_path, 'htdocs')) or \
+            not os.path.isfile(os.path.join(dest_path, 'database.sql')):
+        return "Backup archive is invalid. Missing htdocs or database.sql."
+    return None
+
 class WOBackupController(CementBaseController):
     """Controller for the `wo backup` command."""
     class Meta:
@@ -65,6 +628,9 @@ class WOBackupController(CementBaseController):
         arguments = [
             (['site_name'],
              dict(help='The name of the site to backup', nargs=1)),
+            (['--format'],
+             dict(help='Archive compression format (default: gzip)',
+                  choices=tuple(ARCHIVE_EXTENSIONS), default='gzip')),
         ]
 
     @expose(hide=True)
@@ -75,7 +641,6 @@ class WOBackupController(CementBaseController):
         site_root = f'/var/www/{sitename}'
         htdocs_path = f'{site_root}/htdocs'
         wp_config_path = f'{htdocs_path}/wp-config.php'
-        nginx_config_path = f'/etc/nginx/sites-available/{sitename}'
 
         if not os.path.isdir(htdocs_path):
             Log.error(self.app, f"Site htdocs not found at {htdocs_path}.")
@@ -106,43 +671,31 @@ class WOBackupController(CementBaseController):
             return
         Log.info(self.app, f"-> Credentials found for database '{db_creds['name']}'.")
 
-        # 3. Create temp dir
-        temp_dir = tempfile.mkdtemp()
-
-        try:
-            # 4. Dump database
-            db_dump_path = os.path.join(temp_dir, 'database.sql')
-            Log.info(self.app, "-> Dumping database...")
-            with open(db_dump_path, 'w') as f:
-                process = subprocess.run(
-                    ['mysqldump', '--no-tablespaces', '-u', db_creds['user'], f"-p{db_creds['password']}", db_creds['name']],
-                    stdout=f, stderr=subprocess.PIPE, text=True, check=False
-                )
-                if process.returncode != 0:
-                    Log.error(self.app, f"mysqldump failed: {process.stderr}")
-                    return
+        # 3. Dump database
+        Log.info(self.app, "-> Dumping database...")
+        db_dump, dump_error = _dump_site_database(self.app, db_creds)
+        if db_dump is None:
+            Log.error(self.app, f"mysqldump failed: {dump_error}")
+            return
 
-            # 5. Create archive
+        with db_dump:
+            # 4. Create archive
             timestamp = datetime.now().strftime("%Y-%m-%d-%H%M%S")
-            backup_filename = f"{sitename}-{timestamp}.tar.gz"
+            backup_filename = f"{sitename}-{timestamp}.{ARCHIVE_EXTENSIONS[pargs.format]}"
             backup_filepath = os.path.join(BACKUP_BASE_DIR, backup_filename)
             Log.info(self.app, "-> Archiving website files, database, and Nginx config...")
-            with tarfile.open(backup_filepath, "w:gz") as tar:
-                tar.add(htdocs_path, arcname='htdocs')
-                tar.add(db_dump_path, arcname='database.sql')
-                if os.path.isfile(nginx_config_path):
-                    tar.add(nginx_config_path, arcname=f'nginx/{sitename}')
-                else:
-                    Log.warn(self.app, f"Nginx config not found at {nginx_config_path}, skipping.")
-
+            archive_error = _create_archive(self.app, backup_filepath, pargs.format,
+                                            db_dump, sitename)
+        if archive_error:
+            Log.error(self.app, f"Unable to create backup archive: {archive_error}")
+            return
 
-            backup_size = os.path.getsize(backup_filepath) / (1024*1024)
-            Log.success(self.app, "Backup complete!")
-            Log.info(self.app, f"Backup file created at: {backup_filepath} ({backup_size:.2f} MB)")
+        # 5. Save a checksum restore verifies before touching the site
+        _write_checksum(self.app, backup_filepath)
 
-        finally:
-            # 6. Clean up
-            shutil.rmtree(temp_dir)
+        backup_size = os.path.getsize(backup_filepath) / (1024*1024)
+        Log.success(self.app, "Backup complete!")
+        Log.info(self.app, f"Backup file created at: {backup_filepath} ({backup_size:.2f} MB)")
 
 class WORestoreController(CementBaseController):
     """Controller for the `wo restore` command."""
@@ -155,7 +708,7 @@ class WORestoreController(CementBaseController):
             (['site_name'],
              dict(help='The name of the site to restore', nargs=1)),
             (['backup_path'],
-             dict(help='Path to the backup .tar.gz file', nargs=1)),
+             dict(help='Path to the backup .tar.gz or .tar.zst file', nargs=1)),
         ]
 
     @expose(hide=True)
@@ -166,7 +719,6 @@ class WORestoreController(CementBaseController):
         backup_path = pargs.backup_path[0]
         site_root = f'/var/www/{sitename}'
         htdocs_path = f'{site_root}/htdocs'
-        nginx_config_path = f'/etc/nginx/sites-available/{sitename}'
 
         if not os.path.isfile(backup_path):
             Log.error(self.app, f"Backup file not found at {backup_path}")
@@ -193,21 +745,17 @@ class WORestoreController(CementBaseController):
             return
 
         Log.info(self.app, f"Starting restore for {sitename}...")
-        temp_dir = tempfile.mkdtemp()
+        # Extract next to htdocs so files are swapped in by rename, not copied
+        temp_dir = tempfile.mkdtemp(prefix='.restore-', dir=site_root)
 
         try:
-            # 2. Extract backup
-            Log.info(self.app, "-> Extracting backup file...")
-            with tarfile.open(backup_path, "r:gz") as tar:
-                tar.extractall(path=temp_dir)
+            # 2. Verify and extract backup
+            extract_error = _extract_backup(self.app, backup_path, temp_dir)
+            if extract_error:
+                Log.error(self.app, extract_error)
+                return
 
-            extracted_htdocs = os.path.join(temp_dir, 'htdocs')
             db_dump_path = os.path.join(temp_dir, 'database.sql')
-            extracted_nginx_conf = os.path.join(temp_dir, 'nginx', sitename)
-
-            if not os.path.isdir(extracted_htdocs) or not os.path.isfile(db_dump_path):
-                Log.error(self.app, "Backup archive is invalid. Missing htdocs or database.sql.")
-                return
 
             # 3. Get current DB credentials (from the newly created or existing site)
             Log.info(self.app, "-> Reading database credentials...")
@@ -216,59 +764,29 @@ class WORestoreController(CementBaseController):
                 Log.error(self.app, f"Could not read DB credentials from site at {wp_config_path}")
                 return
 
-            # 4. Drop all tables from current database
-            Log.info(self.app, f"-> Dropping all tables from database '{db_creds['name']}'...")
-            get_tables_sql = "SHOW TABLES;"
-            tables_proc = subprocess.run(
-                ['mysql', '-u', db_creds['user'], f"-p{db_creds['password']}", '-N', db_creds['name'], '-e', get_tables_sql],
-                capture_output=True, text=True, check=False
-            )
-            if tables_proc.stdout:
-                tables = tables_proc.stdout.strip().split('\n')
-                drop_sql = "SET FOREIGN_KEY_CHECKS=0; " + "".join([f"DROP TABLE IF EXISTS `{t}`;" for t in tables]) + " SET FOREIGN_KEY_CHECKS=1;"
-                drop_proc = subprocess.run(
-                    ['mysql', '-u', db_creds['user'], f"-p{db_creds['password']}", db_creds['name'], '-e', drop_sql],
-                    capture_output=True, text=True, check=False
-                )
-                if drop_proc.returncode != 0:
-                    Log.error(self.app, f"Failed to drop tables: {drop_proc.stderr}")
-                    return
-
-            # 5. Import database from backup
-            Log.info(self.app, "-> Importing database from backup...")
-            with open(db_dump_path, 'r') as f:
-                import_proc = subprocess.run(
-                    ['mysql', '-u', db_creds['user'], f"-p{db_creds['password']}", db_creds['name']],
-                    stdin=f, capture_output=True, text=True, check=False
-                )
-                if import_proc.returncode != 0:
-                    Log.error(self.app, f"Database import failed: {import_proc.stderr}")
-                    return
-
-            # 6. Restore files and Nginx config
-            Log.info(self.app, "-> Replacing website files...")
-            if os.path.isdir(htdocs_path):
-                shutil.rmtree(htdocs_path)
-            shutil.move(extracted_htdocs, site_root)
-
-            if os.path.isfile(extracted_nginx_conf):
-                Log.info(self.app, "-> Restoring Nginx configuration...")
-                shutil.copy(extracted_nginx_conf, nginx_config_path)
+            # 4. Replace the current database with the backup
+            db_error = _restore_database(self.app, db_creds, db_dump_path)
+            if db_error:
+                Log.error(self.app, db_error)
+                return
 
-            # 7. Set permissions
-            Log.info(self.app, "-> Setting file and directory permissions...")
-            if not _set_permissions(htdocs_path):
-                Log.warn(self.app, "Could not set www-data permissions. Please set them manually.")
+            # 5. Restore files and Nginx config, then set permissions
+            files_error = _install_site_files(self.app, temp_dir, sitename)
+            if files_error:
+                Log.error(self.app, files_error)
+                return
 
-            # 8. Reload Nginx
+            # 6. Reload Nginx
             Log.info(self.app, "-> Reloading Nginx stack...")
             WOShellExec.cmd_exec(self.app, "wo stack reload --nginx")
 
             Log.success(self.app, "Restore complete!")
 
         finally:
-            # 9. Clean up
-            shutil.rmtree(temp_dir)
+            # 7. Clean up in the background, the old htdocs may hold
+            # thousands of files
+            threading.Thread(target=shutil.rmtree, args=(temp_dir,),
+                             kwargs={'ignore_errors': True}).start()
 
 def load(app):
     """Loads the plugin controllers into the WordOps application"""